@@ -1,23 +1,46 @@
+import aiofiles
+import asyncio
+import contextlib
+import hashlib
 import os
 import shutil
 import tempfile
 import torch
+import torch.nn.functional as F
 import traceback
 import librosa
 import numpy as np
 import uuid
 import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 from typing import List, Dict, Any, Optional
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form, BackgroundTasks
+from fastapi import FastAPI, UploadFile, File, HTTPException, Form, BackgroundTasks, Request
 from fastapi.responses import FileResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
+import torchaudio
 from demucs.pretrained import get_model
-from demucs.audio import AudioFile, save_audio
 from demucs.apply import apply_model
 import soundfile as sf
 
-app = FastAPI()
+# Optional: pedalboard fuses pitch shift + time stretch into a single
+# Rubber Band pass, which is much faster than two librosa passes
+try:
+    from pedalboard import time_stretch as pedalboard_time_stretch
+except ImportError:
+    pedalboard_time_stretch = None
+
+logger = logging.getLogger(__name__)
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Run the one-time model load and kernel warm-ups before serving"""
+    load_model(app)
+    yield
+
+app = FastAPI(lifespan=lifespan)
 
 # Add CORS middleware to allow requests from the frontend
 app.add_middleware(
@@ -32,32 +55,281 @@ app.add_middleware(
 OUTPUT_DIR = os.path.join(os.path.dirname(__file__), "output")
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-# Create a folder for storing processing files
-PROCESSING_DIR = os.path.join(os.path.dirname(__file__), "processing")
+# Create a folder for storing processing files. Prefer tmpfs when the host
+# has it so the per-session intermediate audio lives in RAM and never costs
+# disk I/O; sessions are removed when the mix is finalized anyway
+if os.path.isdir('/dev/shm'):
+    PROCESSING_DIR = '/dev/shm/simul_processing'
+else:
+    PROCESSING_DIR = os.path.join(os.path.dirname(__file__), "processing")
 os.makedirs(PROCESSING_DIR, exist_ok=True)
 
+# Create a folder for caching separated stems, keyed by content hash
+STEM_CACHE_DIR = os.path.join(os.path.dirname(__file__), "stem_cache")
+os.makedirs(STEM_CACHE_DIR, exist_ok=True)
+
+# Single worker so concurrent requests queue for the GPU one at a time
+# instead of oversubscribing it, while inference stays off the event loop
+# and the other endpoints remain responsive
+SEPARATION_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+
+def load_audio(path, samplerate, channels, device=None):
+    """
+    Decode an audio file directly into a tensor with torchaudio.
+
+    The file is decoded at its native rate; resampling and channel
+    remixing then run on the target device, where they parallelize far
+    better than a single-threaded CPU resample.
+
+    Args:
+        path: Path of the audio file to decode
+        samplerate: Sample rate expected by the model
+        channels: Number of channels expected by the model
+        device: Device to place (and resample) the audio on
+
+    Returns:
+        Audio tensor of shape (channels, samples)
+    """
+    waveform, sr = torchaudio.load(path)
+    if device is not None and device.type == 'cuda':
+        waveform = waveform.pin_memory().to(device, non_blocking=True)
+    if sr != samplerate:
+        waveform = torchaudio.functional.resample(waveform, sr, samplerate, lowpass_filter_width=16)
+    if waveform.shape[0] != channels:
+        # Downmix to mono then expand to the channel count the model wants
+        waveform = waveform.mean(dim=0, keepdim=True).expand(channels, -1)
+    return waveform
+
+def encode_mp3_chunked(waveform, path, sample_rate, chunk_seconds=1):
+    """
+    Encode a (channels, samples) float tensor to MP3 in chunks.
+
+    Streams one-second slices through torchaudio's StreamWriter so peak
+    memory during encoding stays at the chunk size instead of holding a
+    second full-track buffer.
+
+    Args:
+        waveform: Audio tensor of shape (channels, samples) in [-1, 1]
+        path: Output MP3 path
+        sample_rate: Sample rate of the audio
+        chunk_seconds: Seconds of audio per encoded chunk
+    """
+    writer = torchaudio.io.StreamWriter(path)
+    writer.add_audio_stream(sample_rate, waveform.shape[0], encoder='libmp3lame')
+    chunk = sample_rate * chunk_seconds
+    with writer.open():
+        for start in range(0, waveform.shape[-1], chunk):
+            writer.write_audio_chunk(0, waveform[:, start:start + chunk].T.contiguous())
+
+def save_stem(tensor, path):
+    """Store a stem as float16 .npy - half the disk traffic of a pickled FP32 tensor"""
+    np.save(path, tensor.cpu().numpy().astype(np.float16))
+
+def load_stem(path):
+    """Load a stem saved by save_stem back into a float32 tensor (memory-mapped read)"""
+    return torch.from_numpy(np.load(path, mmap_mode='r')).float()
+
+# Warm in-process cache of loaded stems keyed by processing_id, so repeated
+# offset adjustments on the same session skip the disk reads entirely. Kept
+# small since each entry holds two full-track tensors
+STEM_CACHE_SIZE = 4
+STEM_CACHE: Dict[str, tuple] = {}
+
+def get_session_stems(processing_dir, processing_id):
+    """
+    Return (vocal_stem, instrumental) for a session.
+
+    Serves from the in-process cache when warm; otherwise loads the
+    memory-mapped .npy stems from the session directory. Insertion order
+    doubles as LRU order: a hit is re-inserted and the oldest entry is
+    evicted when the cache is full.
+    """
+    stems = STEM_CACHE.pop(processing_id, None)
+    if stems is None:
+        stems = (
+            load_stem(os.path.join(processing_dir, 'vocal_stem.npy')),
+            load_stem(os.path.join(processing_dir, 'instrumental.npy')),
+        )
+    STEM_CACHE[processing_id] = stems
+    while len(STEM_CACHE) > STEM_CACHE_SIZE:
+        STEM_CACHE.pop(next(iter(STEM_CACHE)))
+    return stems
+
+def mix_stems(vocal, instrumental):
+    """
+    Trim two stems to their common length and mix them in one fused add.
+
+    torch.add with an explicit out= buffer does the trim + sum as a single
+    elementwise op into one allocation instead of binding intermediate
+    slices and allocating a fresh sum tensor.
+    """
+    length = min(vocal.shape[-1], instrumental.shape[-1])
+    mix = torch.empty_like(vocal[..., :length])
+    torch.add(vocal[..., :length], instrumental[..., :length], out=mix)
+    return mix
+
+def save_preview(mix, path, sample_rate):
+    """
+    Write a preview mix as Ogg/Vorbis.
+
+    Vorbis encodes several times faster than LAME MP3 at comparable
+    perceptual quality, which matters because /adjust-offset re-encodes
+    the preview on every slider move. Browsers play Ogg natively.
+    """
+    sf.write(path, mix.cpu().numpy().T, sample_rate, format='OGG', subtype='VORBIS')
+
+def as_batch(audio):
+    """Give a (channels, samples) tensor a leading batch dimension if needed"""
+    return audio if audio.dim() == 3 else audio.unsqueeze(0)
+
+@contextlib.contextmanager
+def inference_context(device):
+    """
+    Context manager for Demucs inference.
+
+    Runs under torch.inference_mode so no autograd bookkeeping is done.
+    On CUDA this also autocasts to half precision, which halves memory
+    bandwidth and roughly doubles tensor-core throughput for the htdemucs
+    layers. BF16 is preferred where the hardware supports it since it has
+    FP32's exponent range and therefore no overflow risk; older GPUs fall
+    back to FP16.
+    """
+    with torch.inference_mode():
+        if device.type == 'cuda':
+            dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+            with torch.autocast(device_type='cuda', dtype=dtype):
+                yield
+        else:
+            yield
+
+def run_separation(model, mix, device, num_workers):
+    """
+    Run Demucs separation with segment-level parallelism.
+
+    Demucs splits the input into overlapping segments; num_workers > 0
+    processes them in parallel instead of one at a time, keeping the
+    device busy. Progress bars are disabled to skip tqdm overhead.
+    """
+    with inference_context(device):
+        return apply_model(
+            model, mix, device=device,
+            shifts=0, split=True, overlap=0.1,
+            num_workers=num_workers, progress=False,
+        )
+
+def load_model(app: FastAPI):
+    """Load the Demucs model once at startup so requests only pay for inference"""
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    logger.info("Loading Demucs model on %s...", device)
+    model = get_model('htdemucs')
+    model.to(device)
+    model.eval()
+
+    if device.type == 'cpu':
+        # On CPU-only hosts, quantize the linear layers to dynamic int8 so
+        # the transformer blocks (the bulk of htdemucs compute) use VNNI
+        # int8 kernels instead of FP32. Conv layers aren't supported by
+        # dynamic quantization and stay as they are
+        try:
+            model = torch.ao.quantization.quantize_dynamic(
+                model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+            logger.info("Applied int8 dynamic quantization for CPU inference")
+        except Exception as e:
+            logger.warning("Dynamic quantization failed, running in FP32: %s", e)
+
+    # Compile the sub-models inside the bag for fused kernels on the fixed
+    # segment shapes apply_model uses internally. The bag itself must stay a
+    # BagOfModels - wrapping it would break apply_model's isinstance dispatch
+    # - so only its members get compiled, and the eager ones are kept around
+    # in case compilation turns out not to work on this host
+    eager_models = list(model.models)
+    try:
+        for i, sub_model in enumerate(model.models):
+            model.models[i] = torch.compile(sub_model, mode='reduce-overhead', fullgraph=False)
+        logger.info("Demucs sub-models compiled with torch.compile")
+    except Exception as e:
+        for i, sub_model in enumerate(eager_models):
+            model.models[i] = sub_model
+        logger.warning("torch.compile unavailable, running eager: %s", e)
+
+    app.state.model = model
+    app.state.device = device
+
+    # Demucs processes audio in fixed-size segments, so letting cuDNN
+    # benchmark its algorithm choices is safe and pays off after warm-up
+    torch.backends.cudnn.benchmark = True
+
+    # Segment workers for apply_model. demucs only spins up its segment
+    # thread pool on CPU devices - on CUDA the value is ignored and segments
+    # run sequentially on the GPU - so this knob only matters on CPU hosts
+    app.state.num_workers = 0 if device.type == 'cuda' else max(1, os.cpu_count() // 2)
+
+    # Precompute the stem indices once - model.sources never changes after
+    # load, so requests shouldn't rescan it
+    app.state.vocal_idx = model.sources.index('vocals')
+    app.state.instr_idx = torch.tensor(
+        [i for i, name in enumerate(model.sources) if name != 'vocals'],
+        device=device,
+    )
+
+    # Run a couple of warm-up passes on dummy tensors so CUDA context setup,
+    # cuDNN algorithm selection and torch.compile's lazy compilation don't
+    # slow down the first real request. Both batch shapes the handlers feed
+    # through the model get warmed: batch-1 (acapella fast path, cache hits)
+    # and batch-2 (the standard vocal+beat separation), since reduce-overhead
+    # recompiles per shape
+    dummies = [
+        torch.zeros(batch, model.audio_channels, model.samplerate, device=device)
+        for batch in (1, 2)
+    ]
+    try:
+        for dummy in dummies:
+            for _ in range(2):
+                run_separation(model, dummy, device, app.state.num_workers)
+    except Exception as e:
+        # torch.compile is lazy, so compilation failures only surface on these
+        # first forward passes; fall back to the eager sub-models and re-warm
+        logger.warning("Warm-up failed under torch.compile, reverting to eager: %s", e)
+        for i, sub_model in enumerate(eager_models):
+            model.models[i] = sub_model
+        for dummy in dummies:
+            for _ in range(2):
+                run_separation(model, dummy, device, app.state.num_workers)
+
+    # Warm librosa's Numba-compiled effects too, so the first request that
+    # needs a key or tempo change doesn't pay the JIT cost
+    silence = np.zeros(2048, dtype=np.float32)
+    librosa.effects.pitch_shift(silence, sr=22050, n_steps=1)
+    librosa.effects.time_stretch(silence, rate=1.1)
+    logger.info("Demucs model loaded and warmed up")
+
+# Map of musical keys to their semitone positions
+KEY_TO_SEMITONE = {
+    'C': 0, 'C#': 1, 'D': 2, 'D#': 3, 'E': 4, 'F': 5,
+    'F#': 6, 'G': 7, 'G#': 8, 'A': 9, 'A#': 10, 'B': 11,
+    'Cm': 12, 'C#m': 13, 'Dm': 14, 'D#m': 15, 'Em': 16, 'Fm': 17,
+    'F#m': 18, 'Gm': 19, 'G#m': 20, 'Am': 21, 'A#m': 22, 'Bm': 23
+}
+
+@lru_cache(maxsize=1024)
 def calculate_key_semitones(source_key: str, target_key: str) -> int:
     """
     Calculate the number of semitones to transpose from source key to target key.
-    
+
+    The input domain is tiny (24 x 24 key pairs), so after warmup the
+    lru_cache turns every call into a single dict lookup.
+
     Args:
         source_key: The original key
         target_key: The target key
-        
+
     Returns:
         Number of semitones to transpose (positive or negative)
     """
-    # Map of musical keys to their semitone positions
-    key_to_semitone = {
-        'C': 0, 'C#': 1, 'D': 2, 'D#': 3, 'E': 4, 'F': 5, 
-        'F#': 6, 'G': 7, 'G#': 8, 'A': 9, 'A#': 10, 'B': 11,
-        'Cm': 12, 'C#m': 13, 'Dm': 14, 'D#m': 15, 'Em': 16, 'Fm': 17,
-        'F#m': 18, 'Gm': 19, 'G#m': 20, 'Am': 21, 'A#m': 22, 'Bm': 23
-    }
-    
     # Get semitone positions
-    source_pos = key_to_semitone.get(source_key)
-    target_pos = key_to_semitone.get(target_key)
+    source_pos = KEY_TO_SEMITONE.get(source_key)
+    target_pos = KEY_TO_SEMITONE.get(target_key)
     
     if source_pos is None or target_pos is None:
         raise ValueError(f"Invalid key: {source_key if source_pos is None else target_key}")
@@ -97,6 +369,16 @@ def transpose_audio(y, sr, n_steps):
     Returns:
         Transposed audio time series
     """
+    # Whole-semitone shifts within a tritone run on the GPU when one is
+    # around; larger or fractional shifts stay on librosa's phase vocoder
+    if torch.cuda.is_available() and n_steps == int(n_steps) and abs(n_steps) <= 6:
+        try:
+            shifter = torchaudio.transforms.PitchShift(sr, int(n_steps)).to('cuda')
+            with torch.inference_mode():
+                shifted = shifter(torch.from_numpy(np.ascontiguousarray(y)).to('cuda'))
+            return shifted.cpu().numpy()
+        except Exception as e:
+            logger.warning("GPU pitch shift failed, falling back to librosa: %s", e)
     return librosa.effects.pitch_shift(y, sr=sr, n_steps=n_steps)
 
 def adjust_tempo(y, sr, tempo_ratio):
@@ -116,113 +398,214 @@ def adjust_tempo(y, sr, tempo_ratio):
 def find_best_tempo_ratio(source_bpm, target_bpm):
     """
     Find the best tempo ratio to adjust source_bpm to target_bpm.
-    
+
     Instead of slowing down, this function will attempt to find a multiple
     of target_bpm that is close to source_bpm, or vice versa.
-    
+
     Args:
         source_bpm: Original BPM
         target_bpm: Target BPM
-        
+
     Returns:
         Optimal tempo ratio to maintain best quality
     """
+    # Round so near-identical BPM estimates share a cache entry
+    return _find_best_tempo_ratio(round(float(source_bpm), 2), round(float(target_bpm), 2))
+
+@lru_cache(maxsize=256)
+def _find_best_tempo_ratio(source_bpm, target_bpm):
     # Direct ratio (might be slowing down)
     direct_ratio = target_bpm / source_bpm
-    
+
     # If we're already speeding up, just use the direct ratio
     if direct_ratio >= 1.0:
         return direct_ratio
-    
-    # Try to find multiples of target_bpm that are close to source_bpm
-    multiples = []
-    for i in range(1, 5):  # Try up to 4x multiplier
-        ratio = (target_bpm * i) / source_bpm
-        if ratio >= 0.8:  # Don't slow down more than 20%
-            multiples.append((ratio, abs(1 - ratio)))
-    
-    # Try to find fractions of source_bpm that are close to target_bpm
-    for i in range(2, 5):  # Try 1/2, 1/3, 1/4
-        ratio = target_bpm / (source_bpm / i)
-        if ratio >= 0.8:  # Don't slow down more than 20%
-            multiples.append((ratio, abs(1 - ratio)))
-    
+
+    # Multiples of target_bpm and fractions of source_bpm both reduce to
+    # direct_ratio * i, so one candidate array covers the whole search
+    candidates = direct_ratio * np.arange(1, 5)
+    candidates = candidates[candidates >= 0.8]  # Don't slow down more than 20%
+
     # If we found any good multiples, pick the one closest to 1.0 (least change)
-    if multiples:
-        multiples.sort(key=lambda x: x[1])  # Sort by closeness to 1.0
-        return multiples[0][0]
-    
+    if candidates.size:
+        return float(candidates[np.argmin(np.abs(1.0 - candidates))])
+
     # Fall back to direct ratio if no good multiple found
     return direct_ratio
 
 def shift_audio_in_time(audio, sr, offset_beats, bpm):
     """
     Shift audio forward or backward in time by a specified number of beats
-    
+
     Args:
-        audio: Audio time series
+        audio: Audio tensor
         sr: Sample rate
         offset_beats: Number of beats to shift (positive = forward, negative = backward)
         bpm: Beats per minute
-    
+
     Returns:
-        Shifted audio time series
+        Shifted audio tensor
     """
     # Calculate beat duration in seconds
     beat_duration = 60.0 / bpm  # seconds per beat
-    
+
     # Calculate shift in samples
     offset_samples = int(offset_beats * beat_duration * sr)
-    
-    # Create output array with same shape as input, but filled with zeros
-    output = np.zeros_like(audio)
-    
+
+    if offset_samples == 0:
+        return audio.clone()
+
+    # One contiguous roll, then zero the wrapped-around region in place -
+    # no zero-filled allocation or slice-copy of the whole array
+    output = torch.roll(audio, offset_samples, dims=-1)
     if offset_samples > 0:
-        # Shift forward (delay) - move samples later in time
-        output[..., offset_samples:] = audio[..., :-offset_samples]
-    elif offset_samples < 0:
-        # Shift backward - move samples earlier in time
-        offset_samples = abs(offset_samples)
-        output[..., :-offset_samples] = audio[..., offset_samples:]
+        # Shift forward (delay) - the wrap-around lands at the start
+        output[..., :offset_samples] = 0
     else:
-        # No shift
-        output = audio.copy()
-        
+        # Shift backward - the wrap-around lands at the end
+        output[..., offset_samples:] = 0
+
     return output
 
 def normalize_audio(audio, target_dB=-20):
     """
     Normalize audio to a target dB level
-    
+
     Args:
-        audio: Audio time series (numpy array)
+        audio: Audio tensor (stays on whatever device it lives on)
         target_dB: Target dB level (default: -20dB which is good for mixing)
-    
+
     Returns:
-        Normalized audio time series
+        Normalized audio tensor
     """
-    # Calculate current RMS (root mean square) energy
-    rms = np.sqrt(np.mean(audio**2))
-    
+    # Calculate current RMS (root mean square) energy in a single fused
+    # reduction - vector_norm squares and sums in one pass instead of
+    # materializing a full audio**2 temporary first
+    rms = float(torch.linalg.vector_norm(audio) / audio.numel() ** 0.5)
+
     # Convert target dB to linear gain
     target_rms = 10**(target_dB/20.0)
-    
+
     # Calculate gain needed
     gain = target_rms / (rms + 1e-9)  # Adding small value to prevent division by zero
-    
-    print(f"Normalizing audio: current RMS = {20*np.log10(rms+1e-9):.2f} dB, gain = {20*np.log10(gain):.2f} dB")
-    
+
+    logger.debug("Normalizing audio: current RMS = %.2f dB, gain = %.2f dB", 20*np.log10(rms+1e-9), 20*np.log10(gain))
+
     # Apply gain
     return audio * gain
 
+def preprocess_beat(beat_path, processing_dir, vocal_key, beat_key, vocal_bpm, beat_bpm):
+    """
+    Adjust the beat track's key and tempo to match the vocal.
+
+    Pure CPU work with no shared state, so callers can run it in an
+    executor and overlap it with other stages.
+
+    Args:
+        beat_path: Path of the uploaded beat file
+        processing_dir: Session directory to write the processed beat into
+        vocal_key: Key of the vocal track
+        beat_key: Key of the beat track
+        vocal_bpm: BPM of the vocal track
+        beat_bpm: BPM of the beat track
+
+    Returns:
+        Tuple of (path to the beat to separate, adjusted beat BPM)
+    """
+    # Initialize adjusted BPM to the vocal BPM
+    adjusted_beat_bpm = vocal_bpm
+
+    # Process the beat track to match vocal parameters
+    if vocal_key != beat_key or abs(vocal_bpm - beat_bpm) > 1.0:
+        logger.debug("Adjusting beat track from key=%s, bpm=%s to key=%s, bpm=%s", beat_key, beat_bpm, vocal_key, vocal_bpm)
+        # Read with soundfile directly: no resample is wanted here, so
+        # librosa.load's audioread/float64 path would be pure overhead
+        beat_audio_data, beat_sr = sf.read(beat_path, dtype='float32')
+        if beat_audio_data.ndim == 2:
+            # soundfile returns (samples, channels); the effects expect
+            # channels-first like librosa.load would produce
+            beat_audio_data = beat_audio_data.T.copy()
+        processed_beat_path = os.path.join(processing_dir, 'processed_beat.wav')
+
+        # Determine if we need to transpose or adjust tempo
+        needs_transposition = vocal_key != beat_key
+        needs_tempo_adjustment = abs(vocal_bpm - beat_bpm) > 1.0
+
+        # Calculate optimal tempo ratio using our new function
+        tempo_ratio = find_best_tempo_ratio(beat_bpm, vocal_bpm) if needs_tempo_adjustment else 1.0
+
+        # Calculate final BPM after adjustment
+        adjusted_beat_bpm = beat_bpm * tempo_ratio
+        logger.debug("Using tempo ratio: %.4f, resulting in BPM: %.2f", tempo_ratio, adjusted_beat_bpm)
+
+        if pedalboard_time_stretch is not None:
+            # Fuse transposition and tempo change into one Rubber Band
+            # pass instead of running two phase-vocoder passes in a row
+            n_semitones = 0
+            if needs_transposition:
+                try:
+                    n_semitones = calculate_key_semitones(beat_key, vocal_key)
+                    logger.debug("Transposing from %s to %s (%d semitones)", beat_key, vocal_key, n_semitones)
+                except Exception as e:
+                    logger.warning("Error during transposition: %s", e)
+                    n_semitones = 0
+            logger.debug("Fused stretch/shift: ratio=%.4f, semitones=%d", tempo_ratio, n_semitones)
+            beat_audio_data = pedalboard_time_stretch(
+                beat_audio_data, beat_sr,
+                stretch_factor=tempo_ratio,
+                pitch_shift_in_semitones=n_semitones,
+            )
+        # Fall back to the librosa logic for transposition and tempo adjustment
+        elif needs_transposition:
+            try:
+                n_semitones = calculate_key_semitones(beat_key, vocal_key)
+                logger.debug("Transposing from %s to %s (%d semitones)", beat_key, vocal_key, n_semitones)
+
+                # For large transpositions, it's better to transpose first
+                if abs(n_semitones) > 3 or not needs_tempo_adjustment:
+                    logger.debug("Transposing first...")
+                    beat_audio_data = transpose_audio(beat_audio_data, beat_sr, n_semitones)
+
+                    if needs_tempo_adjustment:
+                        logger.debug("Then adjusting tempo with ratio: %.4f", tempo_ratio)
+                        beat_audio_data = adjust_tempo(beat_audio_data, beat_sr, tempo_ratio)
+                else:
+                    # For small transpositions with tempo changes, adjust tempo first
+                    if needs_tempo_adjustment:
+                        logger.debug("Adjusting tempo first with ratio: %.4f", tempo_ratio)
+                        beat_audio_data = adjust_tempo(beat_audio_data, beat_sr, tempo_ratio)
+
+                    logger.debug("Then transposing %d semitones", n_semitones)
+                    beat_audio_data = transpose_audio(beat_audio_data, beat_sr, n_semitones)
+            except Exception as e:
+                logger.warning("Error during transposition: %s", e)
+                # Continue with tempo adjustment only if transposition fails
+                if needs_tempo_adjustment:
+                    logger.debug("Falling back to tempo adjustment only with ratio: %.4f", tempo_ratio)
+                    beat_audio_data = adjust_tempo(beat_audio_data, beat_sr, tempo_ratio)
+        elif needs_tempo_adjustment:
+            logger.debug("Adjusting tempo with ratio: %.4f", tempo_ratio)
+            beat_audio_data = adjust_tempo(beat_audio_data, beat_sr, tempo_ratio)
+
+        # Save the processed beat (soundfile wants samples-first again)
+        if beat_audio_data.ndim == 2:
+            beat_audio_data = beat_audio_data.T
+        sf.write(processed_beat_path, beat_audio_data, beat_sr)
+        logger.debug("Processed beat saved to %s", processed_beat_path)
+        beat_path = processed_beat_path
+
+    return beat_path, adjusted_beat_bpm
+
 @app.post("/prepare-audio")
 async def prepare_audio(
+    request: Request,
     vocal_file: UploadFile = File(...),
     beat_file: UploadFile = File(...),
     vocal_key: Optional[str] = Form(None),
     beat_key: Optional[str] = Form(None), 
     vocal_bpm: Optional[float] = Form(None),
-    beat_bpm: Optional[float] = Form(None)
+    beat_bpm: Optional[float] = Form(None),
+    vocal_is_acapella: bool = Form(False)
 ):
     # Create a unique processing ID
     processing_id = str(uuid.uuid4())
@@ -237,87 +620,119 @@ async def prepare_audio(
         vocal_path = os.path.join(processing_dir, f'vocal{vocal_extension}')
         beat_path = os.path.join(processing_dir, f'beat{beat_extension}')
         
-        # Save uploaded files
-        with open(vocal_path, 'wb') as f:
-            content = await vocal_file.read()
-            f.write(content)
-        await vocal_file.seek(0)
-        
-        with open(beat_path, 'wb') as f:
-            content = await beat_file.read()
-            f.write(content)
-        await beat_file.seek(0)
+        # Stream the uploads to disk in 4 MB chunks, yielding to the event
+        # loop during writes so other requests keep being served. Hash the
+        # chunks as they pass through - it's a single pass, so effectively free
+        async def save_upload(upload, path):
+            digest = hashlib.sha256()
+            async with aiofiles.open(path, 'wb') as f:
+                while chunk := await upload.read(4 * 1024 * 1024):
+                    digest.update(chunk)
+                    await f.write(chunk)
+            return digest
+
+        # The two uploads are independent, so write them concurrently
+        vocal_hash, beat_hash = await asyncio.gather(
+            save_upload(vocal_file, vocal_path),
+            save_upload(beat_file, beat_path),
+        )
         
-        print(f"Files saved to: {vocal_path} and {beat_path}")
+        logger.debug("Files saved to: %s and %s", vocal_path, beat_path)
         
         # Convert to float
         vocal_bpm = float(vocal_bpm)
         beat_bpm = float(beat_bpm)
-        
-        # Initialize adjusted BPM to the vocal BPM
-        adjusted_beat_bpm = vocal_bpm
-
-        # Process the beat track to match vocal parameters
-        if vocal_key != beat_key or abs(vocal_bpm - beat_bpm) > 1.0:
-            print(f"Adjusting beat track from key={beat_key}, bpm={beat_bpm} to key={vocal_key}, bpm={vocal_bpm}")
-            beat_audio_data, beat_sr = librosa.load(beat_path, sr=None)
-            processed_beat_path = os.path.join(processing_dir, 'processed_beat.wav')
-            
-            # Determine if we need to transpose or adjust tempo
-            needs_transposition = vocal_key != beat_key
-            needs_tempo_adjustment = abs(vocal_bpm - beat_bpm) > 1.0
-            
-            # Calculate optimal tempo ratio using our new function
-            tempo_ratio = find_best_tempo_ratio(beat_bpm, vocal_bpm) if needs_tempo_adjustment else 1.0
-            
-            # Calculate final BPM after adjustment
-            adjusted_beat_bpm = beat_bpm * tempo_ratio
-            print(f"Using tempo ratio: {tempo_ratio:.4f}, resulting in BPM: {adjusted_beat_bpm:.2f}")
-            
-            # Continue with the existing logic for transposition and tempo adjustment
-            if needs_transposition:
-                try:
-                    n_semitones = calculate_key_semitones(beat_key, vocal_key)
-                    print(f"Transposing from {beat_key} to {vocal_key} ({n_semitones} semitones)")
-                    
-                    # For large transpositions, it's better to transpose first
-                    if abs(n_semitones) > 3 or not needs_tempo_adjustment:
-                        print("Transposing first...")
-                        beat_audio_data = transpose_audio(beat_audio_data, beat_sr, n_semitones)
-                        
-                        if needs_tempo_adjustment:
-                            print(f"Then adjusting tempo with ratio: {tempo_ratio:.4f}")
-                            beat_audio_data = adjust_tempo(beat_audio_data, beat_sr, tempo_ratio)
-                    else:
-                        # For small transpositions with tempo changes, adjust tempo first
-                        if needs_tempo_adjustment:
-                            print(f"Adjusting tempo first with ratio: {tempo_ratio:.4f}")
-                            beat_audio_data = adjust_tempo(beat_audio_data, beat_sr, tempo_ratio)
-                        
-                        print(f"Then transposing {n_semitones} semitones")
-                        beat_audio_data = transpose_audio(beat_audio_data, beat_sr, n_semitones)
-                except Exception as e:
-                    print(f"Error during transposition: {str(e)}")
-                    # Continue with tempo adjustment only if transposition fails
-                    if needs_tempo_adjustment:
-                        print(f"Falling back to tempo adjustment only with ratio: {tempo_ratio:.4f}")
-                        beat_audio_data = adjust_tempo(beat_audio_data, beat_sr, tempo_ratio)
-            elif needs_tempo_adjustment:
-                print(f"Adjusting tempo with ratio: {tempo_ratio:.4f}")
-                beat_audio_data = adjust_tempo(beat_audio_data, beat_sr, tempo_ratio)
-            
-            # Save the processed beat
-            sf.write(processed_beat_path, beat_audio_data, beat_sr)
-            print(f"Processed beat saved to {processed_beat_path}")
-            beat_path = processed_beat_path
-        
-        # Load Demucs model and process files
-        print("Loading Demucs model...")
-        model = get_model('htdemucs')
-        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        model.to(device)
-        
-        # NOW the model is available, so we can create the metadata
+
+        # Content-addressed cache lookup: the same uploads with the same
+        # settings always produce the same stems, so a repeat request can
+        # reuse them and skip the expensive separation entirely
+        cache_key = hashlib.sha256(
+            f"{vocal_hash.hexdigest()}{beat_hash.hexdigest()}"
+            f"{vocal_key}|{beat_key}|{vocal_bpm}|{beat_bpm}|{vocal_is_acapella}".encode()
+        ).hexdigest()
+        cache_dir = os.path.join(STEM_CACHE_DIR, cache_key)
+        cache_hit = os.path.exists(os.path.join(cache_dir, 'cache.json'))
+
+        if cache_hit:
+            logger.debug("Stem cache hit (%s...), skipping separation", cache_key[:16])
+            with open(os.path.join(cache_dir, 'cache.json'), 'r') as f:
+                cached = json.load(f)
+            adjusted_beat_bpm = cached["final_bpm"]
+            sample_rate = cached["sample_rate"]
+            vocal_stem = load_stem(os.path.join(cache_dir, 'vocal_stem.npy'))
+            instrumental = load_stem(os.path.join(cache_dir, 'instrumental.npy'))
+        else:
+            # Use the model loaded at startup
+            model = request.app.state.model
+            device = request.app.state.device
+            sample_rate = model.samplerate
+
+            # Beat preprocessing and the vocal decode are independent
+            # CPU-bound stages; run both off the event loop and overlap them.
+            # The beat decode depends on the preprocessed file, so it runs in
+            # the same executor task right after preprocess_beat
+            def prepare_and_decode_beat():
+                processed_path, adjusted_bpm = preprocess_beat(
+                    beat_path, processing_dir, vocal_key, beat_key, vocal_bpm, beat_bpm
+                )
+                return load_audio(processed_path, model.samplerate, model.audio_channels, device), adjusted_bpm
+
+            loop = asyncio.get_running_loop()
+            vocal_task = loop.run_in_executor(
+                None, load_audio,
+                vocal_path, model.samplerate, model.audio_channels, device,
+            )
+            beat_task = loop.run_in_executor(None, prepare_and_decode_beat)
+            vocal_audio, (beat_audio, adjusted_beat_bpm) = await asyncio.gather(vocal_task, beat_task)
+
+            vocal_audio = as_batch(vocal_audio)
+            beat_audio = as_batch(beat_audio)
+
+            if vocal_is_acapella:
+                # The vocal file is already an acapella, so skip its Demucs pass
+                # entirely and only separate the beat - halves the GPU work
+                logger.debug("Vocal file marked as acapella, skipping vocal separation")
+                vocal_stem = vocal_audio[0]
+                beat_estimates = await loop.run_in_executor(
+                    SEPARATION_EXECUTOR, run_separation,
+                    model, beat_audio, device, request.app.state.num_workers,
+                )
+                beat_estimates = beat_estimates[0].float()
+            else:
+                # Separate both files in a single batched pass so the fixed per-call
+                # GPU cost is only paid once. Pad the shorter track with zeros to get
+                # equal lengths, then trim the estimates back afterwards.
+                vocal_length = vocal_audio.shape[-1]
+                beat_length = beat_audio.shape[-1]
+                max_length = max(vocal_length, beat_length)
+                batched = torch.stack([
+                    F.pad(vocal_audio[0], (0, max_length - vocal_length)),
+                    F.pad(beat_audio[0], (0, max_length - beat_length)),
+                ], dim=0)
+                estimates = await loop.run_in_executor(
+                    SEPARATION_EXECUTOR, run_separation,
+                    model, batched, device, request.app.state.num_workers,
+                )
+                estimates = estimates.float()
+
+                # Extract vocals from the vocal file
+                vocal_estimates = estimates[0, ..., :vocal_length]
+                vocal_stem = vocal_estimates[request.app.state.vocal_idx]
+
+                # Get the instrumental from the beat file
+                beat_estimates = estimates[1, ..., :beat_length]
+            # Sum the non-vocal stems in one fused gather + reduction using
+            # the indices precomputed at startup
+            instr_idx = request.app.state.instr_idx.to(beat_estimates.device)
+            instrumental = beat_estimates.index_select(0, instr_idx).sum(dim=0)
+
+            # Normalize both stems to a consistent level while they're still
+            # on-device, then pull each one across to the host exactly once,
+            # as a contiguous block
+            logger.debug("Normalizing vocal and instrumental stems...")
+            vocal_stem = normalize_audio(vocal_stem, target_dB=-24).detach().to('cpu').contiguous()
+            instrumental = normalize_audio(instrumental, target_dB=-24).detach().to('cpu').contiguous()
+
         # Save metadata
         metadata = {
             "processing_id": processing_id,
@@ -327,61 +742,34 @@ async def prepare_audio(
             "beat_bpm": beat_bpm,
             "final_key": vocal_key,
             "final_bpm": adjusted_beat_bpm,  # Use the adjusted BPM
-            "sample_rate": model.samplerate,
+            "sample_rate": sample_rate,
             "offset_beats": 0.0  # Start with no offset
         }
-        
-        # Process vocal file - extract vocals
-        vocal_audio = AudioFile(vocal_path).read(streams=0, samplerate=model.samplerate, channels=model.audio_channels)
-        if vocal_audio.dim() == 2:
-            vocal_audio = vocal_audio.unsqueeze(0)
-
-        vocal_estimates = apply_model(model, vocal_audio, device=device)[0]
-        vocal_stem_idx = model.sources.index('vocals')
-        vocal_stem = vocal_estimates[vocal_stem_idx]
-
-        # Process beat file - get instrumental
-        beat_audio = AudioFile(beat_path).read(streams=0, samplerate=model.samplerate, channels=model.audio_channels)
-        if beat_audio.dim() == 2:
-            beat_audio = beat_audio.unsqueeze(0)
-
-        beat_estimates = apply_model(model, beat_audio, device=device)[0]
-        instrumental_sources = [i for i, name in enumerate(model.sources) if name != 'vocals']
-        instrumental_stems = [beat_estimates[i] for i in instrumental_sources]
-        instrumental = sum(instrumental_stems)
-
-        # Convert tensors to numpy arrays for normalization
-        vocal_np = vocal_stem.cpu().numpy()
-        instrumental_np = instrumental.cpu().numpy()
-
-        # Normalize both stems to a consistent level
-        print("Normalizing vocal and instrumental stems...")
-        vocal_np_normalized = normalize_audio(vocal_np, target_dB=-24)
-        instrumental_np_normalized = normalize_audio(instrumental_np, target_dB=-24)  # Slightly quieter for instruments
-
-        # Convert back to torch tensors
-        vocal_stem = torch.from_numpy(vocal_np_normalized)
-        instrumental = torch.from_numpy(instrumental_np_normalized)
-
-        # Save the extracted stems
-        vocal_stem_path = os.path.join(processing_dir, 'vocal_stem.pt')
-        instrumental_path = os.path.join(processing_dir, 'instrumental.pt')
-        
-        # Save as PyTorch tensors
-        torch.save(vocal_stem, vocal_stem_path)
-        torch.save(instrumental, instrumental_path)
-        
+
+        # Save the extracted stems as float16 .npy files
+        vocal_stem_path = os.path.join(processing_dir, 'vocal_stem.npy')
+        instrumental_path = os.path.join(processing_dir, 'instrumental.npy')
+        save_stem(vocal_stem, vocal_stem_path)
+        save_stem(instrumental, instrumental_path)
+
+        if not cache_hit:
+            # Populate the stem cache for future identical requests. The
+            # cache.json is written last so a partially copied entry is
+            # never treated as a hit
+            os.makedirs(cache_dir, exist_ok=True)
+            shutil.copy(vocal_stem_path, os.path.join(cache_dir, 'vocal_stem.npy'))
+            shutil.copy(instrumental_path, os.path.join(cache_dir, 'instrumental.npy'))
+            with open(os.path.join(cache_dir, 'cache.json'), 'w') as f:
+                json.dump({"final_bpm": adjusted_beat_bpm, "sample_rate": sample_rate}, f)
+
         metadata_path = os.path.join(processing_dir, 'metadata.json')
         with open(metadata_path, 'w') as f:
             json.dump(metadata, f)
-        
+
         # Create a preview with no offset
-        preview_path = os.path.join(processing_dir, 'preview.mp3')
-        min_length = min(vocal_stem.shape[-1], instrumental.shape[-1])
-        vocal_stem_preview = vocal_stem[..., :min_length]
-        instrumental_preview = instrumental[..., :min_length]
-        preview_mix = vocal_stem_preview + instrumental_preview
-        save_audio(preview_mix, preview_path, model.samplerate)
+        preview_path = os.path.join(processing_dir, 'preview.ogg')
+        preview_mix = mix_stems(vocal_stem, instrumental)
+        save_preview(preview_mix, preview_path, sample_rate)
         
         return {
             "success": True,
@@ -396,8 +784,7 @@ async def prepare_audio(
         
     except Exception as e:
         error_details = traceback.format_exc()
-        print(f"Error preparing audio: {str(e)}")
-        print(error_details)
+        logger.error("Error preparing audio: %s\n%s", e, error_details)
         
         # Clean up the processing directory on error
         if os.path.exists(processing_dir):
@@ -411,15 +798,15 @@ async def prepare_audio(
 @app.get("/preview/{processing_id}")
 async def get_preview(processing_id: str):
     """Serve the preview audio file"""
-    preview_path = os.path.join(PROCESSING_DIR, processing_id, 'preview.mp3')
+    preview_path = os.path.join(PROCESSING_DIR, processing_id, 'preview.ogg')
     if not os.path.exists(preview_path):
         raise HTTPException(status_code=404, detail="Preview not found")
-        
+
     return FileResponse(
         preview_path,
-        media_type='audio/mpeg',
+        media_type='audio/ogg',
         headers={
-            "Content-Disposition": "inline; filename=preview.mp3",
+            "Content-Disposition": "inline; filename=preview.ogg",
             "Accept-Ranges": "bytes"
         }
     )
@@ -440,30 +827,21 @@ async def adjust_offset(
         with open(metadata_path, 'r') as f:
             metadata = json.load(f)
             
-        # Load stems
-        vocal_stem = torch.load(os.path.join(processing_dir, 'vocal_stem.pt'))
-        instrumental = torch.load(os.path.join(processing_dir, 'instrumental.pt'))
-        
-        # Convert vocal stem to numpy for processing
-        vocal_np = vocal_stem.cpu().numpy()
+        # Load stems (warm from the in-process cache on repeat adjustments)
+        vocal_stem, instrumental = get_session_stems(processing_dir, processing_id)
 
-        # Shift vocal in time according to offset
+        # Shift vocal in time according to offset - the stem stays a tensor,
+        # so there's no numpy round trip
         vocal_bpm = metadata["vocal_bpm"]
-        shifted_vocal_np = shift_audio_in_time(vocal_np, metadata["sample_rate"], offset_beats, vocal_bpm)
+        shifted_vocal = shift_audio_in_time(vocal_stem, metadata["sample_rate"], offset_beats, vocal_bpm)
 
-        # Normalize the shifted vocals
-        shifted_vocal_np = normalize_audio(shifted_vocal_np, target_dB=-24)
+        # No re-normalization here: the shift only moves samples around, and
+        # the stem was already normalized to -24 dB during preparation
 
-        # Convert back to torch tensor
-        shifted_vocal = torch.from_numpy(shifted_vocal_np)
-        
         # Generate new preview
-        preview_path = os.path.join(processing_dir, 'preview.mp3')
-        min_length = min(shifted_vocal.shape[-1], instrumental.shape[-1])
-        vocal_preview = shifted_vocal[..., :min_length]
-        instrumental_preview = instrumental[..., :min_length]
-        preview_mix = vocal_preview + instrumental_preview
-        save_audio(preview_mix, preview_path, metadata["sample_rate"])
+        preview_path = os.path.join(processing_dir, 'preview.ogg')
+        preview_mix = mix_stems(shifted_vocal, instrumental)
+        save_preview(preview_mix, preview_path, metadata["sample_rate"])
         
         # Update metadata
         metadata["offset_beats"] = float(offset_beats)
@@ -479,8 +857,7 @@ async def adjust_offset(
         
     except Exception as e:
         error_details = traceback.format_exc()
-        print(f"Error adjusting offset: {str(e)}")
-        print(error_details)
+        logger.error("Error adjusting offset: %s\n%s", e, error_details)
         return JSONResponse(
             status_code=500,
             content={"error": str(e), "details": error_details}
@@ -506,27 +883,26 @@ async def finalize_mix(
         output_filename = f"processed_mix_{processing_id}.mp3"
         output_path = os.path.join(OUTPUT_DIR, output_filename)
         
-        # Load stems
-        vocal_stem = torch.load(os.path.join(processing_dir, 'vocal_stem.pt'))
-        instrumental = torch.load(os.path.join(processing_dir, 'instrumental.pt'))
+        # Load stems (warm from the in-process cache on repeat adjustments)
+        vocal_stem, instrumental = get_session_stems(processing_dir, processing_id)
         
         # Apply offset if needed
         if metadata["offset_beats"] != 0:
-            vocal_np = vocal_stem.cpu().numpy()
-            shifted_vocal_np = shift_audio_in_time(
-                vocal_np, metadata["sample_rate"], 
+            vocal_stem = shift_audio_in_time(
+                vocal_stem, metadata["sample_rate"],
                 metadata["offset_beats"], metadata["vocal_bpm"]
             )
-            vocal_stem = torch.from_numpy(shifted_vocal_np)
         
         # Mix and save
-        min_length = min(vocal_stem.shape[-1], instrumental.shape[-1])
-        vocal_final = vocal_stem[..., :min_length]
-        instrumental_final = instrumental[..., :min_length]
-        final_mix = vocal_final + instrumental_final
-        save_audio(final_mix, output_path, metadata["sample_rate"])
+        final_mix = mix_stems(vocal_stem, instrumental)
+
+        # Encode the MP3 in-process and in chunks instead of going through
+        # save_audio's per-request encoder subprocess
+        final_mix = final_mix.cpu().float().clamp(-1, 1)
+        encode_mp3_chunked(final_mix, output_path, metadata["sample_rate"])
         
         # Schedule cleanup in the background
+        STEM_CACHE.pop(processing_id, None)
         if background_tasks:
             background_tasks.add_task(shutil.rmtree, processing_dir)
         
@@ -554,8 +930,7 @@ async def finalize_mix(
         
     except Exception as e:
         error_details = traceback.format_exc()
-        print(f"Error finalizing mix: {str(e)}")
-        print(error_details)
+        logger.error("Error finalizing mix: %s\n%s", e, error_details)
         return JSONResponse(
             status_code=500,
             content={"error": str(e), "details": error_details}